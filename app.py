@@ -4,8 +4,10 @@ import json
 import tempfile
 import uuid
 import re
+import hashlib
 from pathlib import Path
-from fastapi import FastAPI, Depends, HTTPException, status, UploadFile, File, BackgroundTasks
+from fastapi import FastAPI, Depends, HTTPException, status, UploadFile, File, Form, BackgroundTasks, Request
+from fastapi.responses import StreamingResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from datetime import datetime, timedelta, timezone
 from jose import JWTError, jwt
@@ -36,6 +38,9 @@ oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
 
 # --- Global State & Environment Variables ---
 SESSION_VECTOR_STORES = {}  # For Temporary Mode
+SESSION_DOCUMENT_CACHE = {}  # (userid, sha256) -> processed chunks, so clients can skip re-uploading unchanged files
+SESSION_DOCUMENT_CACHE_MAX_BYTES = 128 * 1024 * 1024  # chunk text + embeddings, shared by all users of this worker
+MAX_BATCH_QUERIES = 100  # bounds the work (and the embedding batch) one /evaluate/batch request can queue
 AI21_API_KEY_ENV = os.getenv("AI21_API_KEY")
 MONGO_USER_ENV = os.getenv("USERN")
 MONGO_PASS_ENV = os.getenv("PASSW")
@@ -88,6 +93,9 @@ class QueryRequest(BaseModel):
     query_text: str
     source_files: Optional[List[str]] = Field(default_factory=list)
 
+class DocumentHashes(BaseModel):
+    hashes: List[str]
+
 class RegisterUser(BaseModel):
     userid: str
     emailid: str
@@ -127,6 +135,77 @@ def clean_and_parse_json(llm_response_str: str) -> dict:
         logger.error(f"LLM did not return valid JSON, even after cleaning. Raw response: {llm_response_str}", exc_info=True)
         return {"Decision": "Error", "Amount": 0, "Justification": "AI failed to generate a valid structured response."}
 
+# --- RAG Helpers ---
+def run_persistent_rag(query_req: QueryRequest, user_query_embedding: list):
+    """Retrieves context from the persistent KB and asks the LLM for a decision.
+    Returns (structured_response, used_knowledge_base)."""
+    user_query = query_req.query_text
+    vector_search_stage = {
+        "$vectorSearch": {
+            "index": ATLAS_VECTOR_SEARCH_INDEX_NAME, "path": "embedding_vector",
+            "queryVector": user_query_embedding, "numCandidates": 100, "limit": 5
+        }
+    }
+    if query_req.source_files:
+        vector_search_stage["$vectorSearch"]["filter"] = { "metadata.source_document": { "$in": query_req.source_files } }
+    
+    vector_search_pipeline = [vector_search_stage, {"$project": {"_id": 0, "text_chunk": 1, "metadata": 1, "score": {"$meta": "vectorSearchScore"}}}]
+    retrieved_mongo_results = list(mongo_kb_collection.aggregate(vector_search_pipeline))
+
+    if retrieved_mongo_results and retrieved_mongo_results[0]['score'] >= MONGO_SCORE_THRESHOLD:
+        logger.info(f"Relevant KB context found from MongoDB (top score: {retrieved_mongo_results[0]['score']:.4f}).")
+
+        context_for_llm_str = "\n--- Provided Documents Context ---\n"
+        for i, doc in enumerate(retrieved_mongo_results):
+            metadata = doc.get('metadata', {})
+            source_doc = metadata.get('source_document', 'N/A')
+            clause_section = metadata.get('policy_section', '')
+            clause_num = metadata.get('policy_clause_num', '')
+            citation_ref = f"[{clause_section}, Clause {clause_num} (Source: {source_doc})]"
+            context_for_llm_str += f"Citation Reference: {citation_ref}\n"
+            context_for_llm_str += f"Content: {doc.get('text_chunk', '')}\n\n"
+        context_for_llm_str += "--- End of Provided Documents Context ---\n"
+        logger.info(f"Context provided to llm\n: {context_for_llm_str}")
+
+        system_prompt_rag = (
+            "You are a stateless, rule-based JSON generation API. Your ONLY function is to analyze a user query and provided context and return a single, valid JSON object. "
+            "Your entire response MUST be the JSON object itself, with no other text.\n\n"
+
+            "REASONING RULES:\n"
+            "1.  **Analyze Query & Context:** Base your decision ONLY on the provided context and the user's query. Do NOT assume facts not explicitly stated (e.g., do not assume an 'Accident' if not mentioned).\n\n"
+            "2.  **Check for Overriding Rules First:** Before approving, you MUST check for specific conditions that would reject the claim:\n"
+            "    - **Definitions:** Does the situation violate a core definition (e.g., is the location a 'health spa' instead of a 'Hospital')?\n"
+            "    - **Waiting Periods:** Does the claim fall within the 30-day, 24-month, or 36-month waiting periods?\n"
+            "    - **Exclusions:** Is the condition explicitly excluded (e.g., 'Cosmetic Surgery', 'Hazardous Sports')?\n\n"
+            "3.  **Prioritize Exceptions:** If a waiting period or exclusion applies, you MUST check for an exception. An **'Accident'** is a critical exception that overrides most waiting periods.\n\n"
+            "4.  **Handle Financials:** Check for specific financial rules like **Sub-limits** (e.g., for Robotic Surgery), **Co-payments** (e.g., Zone-based), or **Deductions** (e.g., Room Rent). If these apply, the 'Decision' MUST be 'Partially Approved' or similar. If no specific amount or percentage is in the context, the 'Amount' MUST be null.\n\n"
+
+            "JSON OUTPUT REQUIREMENTS:\n"
+            "-   Return ONLY the JSON. 'Decision' must be one of 'Approved', 'Rejected', 'Partially Approved', 'Conditional'.\n"
+            "-   The 'Justification' must cite the specific reason and clause from the context.\n\n"
+            
+            f"CONTEXT:\n{context_for_llm_str}"
+        )
+        final_user_query = (
+            f"User Query: '{user_query}'.\n\n"
+            "=== TASK ===\n"
+            "Based on the query and the context provided in the system prompt, generate ONLY the raw JSON object as your response."
+        )
+        final_messages_for_ai21 = [
+            ChatMessage(role="system", content=system_prompt_rag),
+            ChatMessage(role="user", content=final_user_query)
+        ]
+        
+        ai_api_response = ai21_client.chat.completions.create(model="jamba-mini-1.6-2025-03", messages=final_messages_for_ai21)
+        return clean_and_parse_json(ai_api_response.choices[0].message.content), True
+    return {"Decision": "Cannot Determine", "Amount": 0, "Justification": OUT_OF_KB_SCOPE_MESSAGE}, False
+
+def record_chat_history(userid: str, user_query: str, structured_response, used_knowledge_base: bool):
+    users_collection.update_one(
+        {"userid": userid},
+        {"$push": {"chat_history": {"$each": [{"role": "user", "content": user_query, "timestamp": datetime.now(timezone.utc)}, {"role": "assistant", "content": structured_response, "timestamp": datetime.now(timezone.utc), "used_knowledge_base": used_knowledge_base}]}}}
+    )
+
 # --- API Endpoints ---
 
 @app.post("/evaluate", summary="Evaluate a query against the persistent Knowledge Base")
@@ -134,138 +213,145 @@ async def evaluate_endpoint(
     query_req: QueryRequest,
     current_user: dict = Depends(get_current_user)
 ):
-    user_query = query_req.query_text
-    structured_response = {}
-    used_knowledge_base = False
-
     if app_embedding_model is None:
         raise HTTPException(status_code=503, detail="AI embedding service is unavailable.")
 
     try:
-        user_query_embedding = app_embedding_model.encode(user_query).tolist()
-
-        vector_search_stage = {
-            "$vectorSearch": {
-                "index": ATLAS_VECTOR_SEARCH_INDEX_NAME, "path": "embedding_vector",
-                "queryVector": user_query_embedding, "numCandidates": 100, "limit": 5
-            }
-        }
-        if query_req.source_files:
-            vector_search_stage["$vectorSearch"]["filter"] = { "metadata.source_document": { "$in": query_req.source_files } }
-        
-        vector_search_pipeline = [vector_search_stage, {"$project": {"_id": 0, "text_chunk": 1, "metadata": 1, "score": {"$meta": "vectorSearchScore"}}}]
-        retrieved_mongo_results = list(mongo_kb_collection.aggregate(vector_search_pipeline))
-
-        if retrieved_mongo_results and retrieved_mongo_results[0]['score'] >= MONGO_SCORE_THRESHOLD:
-            used_knowledge_base = True
-            logger.info(f"Relevant KB context found from MongoDB (top score: {retrieved_mongo_results[0]['score']:.4f}).")
-
-            context_for_llm_str = "\n--- Provided Documents Context ---\n"
-            for i, doc in enumerate(retrieved_mongo_results):
-                metadata = doc.get('metadata', {})
-                source_doc = metadata.get('source_document', 'N/A')
-                clause_section = metadata.get('policy_section', '')
-                clause_num = metadata.get('policy_clause_num', '')
-                citation_ref = f"[{clause_section}, Clause {clause_num} (Source: {source_doc})]"
-                context_for_llm_str += f"Citation Reference: {citation_ref}\n"
-                context_for_llm_str += f"Content: {doc.get('text_chunk', '')}\n\n"
-            context_for_llm_str += "--- End of Provided Documents Context ---\n"
-            logger.info(f"Context provided to llm\n: {context_for_llm_str}")
-
-            system_prompt_rag = (
-                "You are a stateless, rule-based JSON generation API. Your ONLY function is to analyze a user query and provided context and return a single, valid JSON object. "
-                "Your entire response MUST be the JSON object itself, with no other text.\n\n"
-
-                "REASONING RULES:\n"
-                "1.  **Analyze Query & Context:** Base your decision ONLY on the provided context and the user's query. Do NOT assume facts not explicitly stated (e.g., do not assume an 'Accident' if not mentioned).\n\n"
-                "2.  **Check for Overriding Rules First:** Before approving, you MUST check for specific conditions that would reject the claim:\n"
-                "    - **Definitions:** Does the situation violate a core definition (e.g., is the location a 'health spa' instead of a 'Hospital')?\n"
-                "    - **Waiting Periods:** Does the claim fall within the 30-day, 24-month, or 36-month waiting periods?\n"
-                "    - **Exclusions:** Is the condition explicitly excluded (e.g., 'Cosmetic Surgery', 'Hazardous Sports')?\n\n"
-                "3.  **Prioritize Exceptions:** If a waiting period or exclusion applies, you MUST check for an exception. An **'Accident'** is a critical exception that overrides most waiting periods.\n\n"
-                "4.  **Handle Financials:** Check for specific financial rules like **Sub-limits** (e.g., for Robotic Surgery), **Co-payments** (e.g., Zone-based), or **Deductions** (e.g., Room Rent). If these apply, the 'Decision' MUST be 'Partially Approved' or similar. If no specific amount or percentage is in the context, the 'Amount' MUST be null.\n\n"
-
-                "JSON OUTPUT REQUIREMENTS:\n"
-                "-   Return ONLY the JSON. 'Decision' must be one of 'Approved', 'Rejected', 'Partially Approved', 'Conditional'.\n"
-                "-   The 'Justification' must cite the specific reason and clause from the context.\n\n"
-                
-                f"CONTEXT:\n{context_for_llm_str}"
-            )
-            final_user_query = (
-                f"User Query: '{user_query}'.\n\n"
-                "=== TASK ===\n"
-                "Based on the query and the context provided in the system prompt, generate ONLY the raw JSON object as your response."
-            )
-            final_messages_for_ai21 = [
-                ChatMessage(role="system", content=system_prompt_rag),
-                ChatMessage(role="user", content=final_user_query)
-            ]
-            
-            ai_api_response = ai21_client.chat.completions.create(model="jamba-mini-1.6-2025-03", messages=final_messages_for_ai21)
-            structured_response = clean_and_parse_json(ai_api_response.choices[0].message.content)
-        else:
-            structured_response = {"Decision": "Cannot Determine", "Amount": 0, "Justification": OUT_OF_KB_SCOPE_MESSAGE}
-
+        user_query_embedding = app_embedding_model.encode(query_req.query_text).tolist()
+        structured_response, used_knowledge_base = run_persistent_rag(query_req, user_query_embedding)
     except Exception as e:
         logger.error(f"Error during RAG process in /evaluate: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail="An error occurred while processing your request.")
 
-    users_collection.update_one(
-        {"userid": current_user["userid"]},
-        {"$push": {"chat_history": {"$each": [{"role": "user", "content": user_query, "timestamp": datetime.now(timezone.utc)}, {"role": "assistant", "content": structured_response, "timestamp": datetime.now(timezone.utc), "used_knowledge_base": used_knowledge_base}]}}}
-    )
+    record_chat_history(current_user["userid"], query_req.query_text, structured_response, used_knowledge_base)
     return structured_response
 
+@app.post("/evaluate/batch", summary="Evaluate many queries against the persistent Knowledge Base in one request")
+async def evaluate_batch_endpoint(
+    request: Request,
+    current_user: dict = Depends(get_current_user)
+):
+    """Takes an NDJSON body of QueryRequest objects and streams back one NDJSON result per query, in order."""
+    if app_embedding_model is None:
+        raise HTTPException(status_code=503, detail="AI embedding service is unavailable.")
+    lines = [line for line in (await request.body()).splitlines() if line.strip()]
+    if not lines: raise HTTPException(status_code=400, detail="No queries were provided.")
+    # Checked before parsing, so an oversized batch is rejected without building any models
+    if len(lines) > MAX_BATCH_QUERIES:
+        raise HTTPException(status_code=413, detail=f"A batch may contain at most {MAX_BATCH_QUERIES} queries.")
+    try:
+        query_reqs = [QueryRequest(**json.loads(line)) for line in lines]
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Request body must be NDJSON, one QueryRequest object per line.")
+
+    try:
+        # One batched encode instead of one per query
+        query_embeddings = app_embedding_model.encode([query_req.query_text for query_req in query_reqs]).tolist()
+    except Exception as e:
+        logger.error(f"Error during embedding in /evaluate/batch: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail="An error occurred while processing your request.")
+
+    def generate_results():
+        for query_req, user_query_embedding in zip(query_reqs, query_embeddings):
+            try:
+                structured_response, used_knowledge_base = run_persistent_rag(query_req, user_query_embedding)
+            except Exception as e:
+                logger.error(f"Error during RAG process in /evaluate/batch: {e}", exc_info=True)
+                structured_response, used_knowledge_base = {"Decision": "Error", "Amount": 0, "Justification": "An error occurred while processing this query."}, False
+            record_chat_history(current_user["userid"], query_req.query_text, structured_response, used_knowledge_base)
+            yield json.dumps({"query_text": query_req.query_text, "response": structured_response}) + "\n"
+
+    return StreamingResponse(generate_results(), media_type="application/x-ndjson")
+
+@app.post("/session/documents/precheck", summary="Report which documents must be uploaded to start a session")
+async def precheck_session_documents(
+    hashes_req: DocumentHashes,
+    current_user: dict = Depends(get_current_user)
+):
+    user_id = current_user["userid"]
+    return {"missing": [digest for digest in hashes_req.hashes if (user_id, digest) not in SESSION_DOCUMENT_CACHE]}
+
+def process_session_document(file_bytes: bytes, filename: str) -> dict:
+    """Chunks and embeds one uploaded document."""
+    with tempfile.NamedTemporaryFile(delete=False, suffix=Path(filename).suffix) as tmp:
+        tmp.write(file_bytes)
+    try:
+        if Path(tmp.name).suffix.lower() == ".pdf": loader = PyPDFLoader(tmp.name)
+        else: loader = TextLoader(tmp.name, encoding='utf-8')
+        text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=150)
+        chunks = text_splitter.split_documents(loader.load())
+    finally:
+        os.unlink(tmp.name)
+    for chunk in chunks: chunk.metadata["source"] = filename
+    documents = [chunk.page_content for chunk in chunks]
+    # Kept as the model's float32 ndarray (4 bytes per dimension, not ~32 as a list of Python floats)
+    embeddings = app_embedding_model.encode(documents) if documents else None
+    nbytes = (embeddings.nbytes if embeddings is not None else 0) + sum(len(text) for text in documents)  # approximate
+    return {"documents": documents, "embeddings": embeddings, "metadatas": [chunk.metadata for chunk in chunks], "nbytes": nbytes}
+
+def cache_session_document(cache_key: tuple, processed: dict):
+    """Caches a processed document, evicting the oldest entries to stay within SESSION_DOCUMENT_CACHE_MAX_BYTES."""
+    if processed["nbytes"] > SESSION_DOCUMENT_CACHE_MAX_BYTES: return
+    cached_bytes = sum(entry["nbytes"] for entry in SESSION_DOCUMENT_CACHE.values())
+    while SESSION_DOCUMENT_CACHE and cached_bytes + processed["nbytes"] > SESSION_DOCUMENT_CACHE_MAX_BYTES:
+        cached_bytes -= SESSION_DOCUMENT_CACHE.pop(next(iter(SESSION_DOCUMENT_CACHE)))["nbytes"]
+    SESSION_DOCUMENT_CACHE[cache_key] = processed
+
+def session_document_as(processed: dict, filename: Optional[str]) -> dict:
+    """A cached document as used by one session: its chunks cite the name it was uploaded under this time."""
+    if filename is None: return processed
+    return {**processed, "metadatas": [{**metadata, "source": filename} for metadata in processed["metadatas"]]}
+
 @app.post("/session/documents", summary="Upload documents to start a temporary RAG session")
 async def upload_documents_for_session(
-    files: List[UploadFile] = File(...),
-    current_user: dict = Depends(get_current_user),
-    background_tasks: BackgroundTasks = BackgroundTasks()
+    files: Optional[List[UploadFile]] = File(None),
+    cached_hashes: Optional[List[str]] = Form(None),
+    cached_filenames: Optional[List[str]] = Form(None),
+    current_user: dict = Depends(get_current_user)
 ):
     user_id = current_user["userid"]
     if user_id in SESSION_VECTOR_STORES:
         logger.info(f"Clearing previous session for user: {user_id}")
         del SESSION_VECTOR_STORES[user_id]
-    if not files: raise HTTPException(status_code=400, detail="No files were uploaded.")
+    files, cached_hashes = files or [], cached_hashes or []
+    # Names for the documents referenced by hash, in the same order; without them the first upload's name is cited
+    if not cached_filenames or len(cached_filenames) != len(cached_hashes): cached_filenames = [None] * len(cached_hashes)
+    if not files and not cached_hashes: raise HTTPException(status_code=400, detail="No files were uploaded.")
+
+    evicted = [digest for digest in cached_hashes if (user_id, digest) not in SESSION_DOCUMENT_CACHE]
+    if evicted: raise HTTPException(status_code=409, detail=f"Documents are no longer cached and must be re-uploaded: {evicted}")
 
-    chunked_documents = []; temp_files_to_clean = []
     try:
+        processed_documents = [session_document_as(SESSION_DOCUMENT_CACHE[(user_id, digest)], filename) for digest, filename in zip(cached_hashes, cached_filenames)]
         for uploaded_file in files:
-            with tempfile.NamedTemporaryFile(delete=False, suffix=Path(uploaded_file.filename).suffix) as tmp:
-                tmp.write(await uploaded_file.read()); temp_files_to_clean.append(tmp.name)
-            
-            file_extension = Path(tmp.name).suffix.lower()
-            if file_extension == ".pdf": loader = PyPDFLoader(tmp.name)
-            else: loader = TextLoader(tmp.name, encoding='utf-8')
-            
-            docs_from_file = loader.load()
-            text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=150)
-            chunks = text_splitter.split_documents(docs_from_file)
-            for chunk in chunks: chunk.metadata["source"] = uploaded_file.filename
-            chunked_documents.extend(chunks)
+            file_bytes = await uploaded_file.read()
+            cache_key = (user_id, hashlib.sha256(file_bytes).hexdigest())
+            processed = SESSION_DOCUMENT_CACHE.get(cache_key)
+            if processed is None:
+                processed = process_session_document(file_bytes, uploaded_file.filename)
+                cache_session_document(cache_key, processed)
+            processed_documents.append(session_document_as(processed, uploaded_file.filename))
 
-        if not chunked_documents: raise HTTPException(status_code=400, detail="Could not process any uploaded documents.")
+        docs_to_embed = [text for doc in processed_documents for text in doc["documents"]]
+        if not docs_to_embed: raise HTTPException(status_code=400, detail="Could not process any uploaded documents.")
 
         session_chroma_client = chromadb.Client()
         collection_name = f"session_collection_{user_id}_{uuid.uuid4().hex}"
         session_collection = session_chroma_client.create_collection(name=collection_name)
-        
-        docs_to_embed = [chunk.page_content for chunk in chunked_documents]
-        embeddings_to_add = app_embedding_model.encode(docs_to_embed).tolist()
 
         session_collection.add(
-            ids=[f"chunk_{i}" for i in range(len(chunked_documents))],
-            embeddings=embeddings_to_add, documents=docs_to_embed, metadatas=[chunk.metadata for chunk in chunked_documents]
+            ids=[f"chunk_{i}" for i in range(len(docs_to_embed))],
+            embeddings=[emb for doc in processed_documents if doc["embeddings"] is not None for emb in doc["embeddings"].tolist()], documents=docs_to_embed,
+            metadatas=[meta for doc in processed_documents for meta in doc["metadatas"]]
         )
         
         SESSION_VECTOR_STORES[user_id] = session_collection
         logger.info(f"Successfully created and cached vector store for user: {user_id}")
-        return {"message": f"Successfully processed {len(files)} documents. You can now query them.", "session_user": user_id}
+        return {"message": f"Successfully processed {len(processed_documents)} documents. You can now query them.", "session_user": user_id}
+    except HTTPException: raise
     except Exception as e:
         logger.error(f"Error creating session vector store for user {user_id}: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail="Failed to create session knowledge base.")
-    finally:
-        for path in temp_files_to_clean: background_tasks.add_task(os.unlink, path)
 
 @app.post("/session/query", summary="Query the current temporary session")
 async def query_session_documents(
@@ -1,129 +1,423 @@
-import requests
-import shlex
 import os
+import sys
+import re
 import json
+import time
+import tempfile
+import base64
+import mimetypes
+import difflib
+import mmap
+import stat
 from pathlib import Path
-from rich.console import Console
+import orjson
+from rich.console import Console, Group
 from rich.panel import Panel
 from rich.table import Table
-from rich.syntax import Syntax
+from rich.text import Text
+from rich.markup import escape
 
 # --- Configuration ---
 BASE_URL = os.getenv("CLAUSECOMPASS_API_URL", "http://localhost:8000")
 PERSISTENT_ENDPOINT = "/evaluate"
+BATCH_ENDPOINT = "/evaluate/batch"
 SESSION_UPLOAD_ENDPOINT = "/session/documents"
 SESSION_QUERY_ENDPOINT = "/session/query"
+SESSION_PRECHECK_ENDPOINT = "/session/documents/precheck"
+# (connect, read) timeouts; RAG queries and document processing get a longer read window
+REQUEST_TIMEOUT = (3.05, 30)
+QUERY_TIMEOUT = (3.05, 120)
+UPLOAD_TIMEOUT = (3.05, 300)
+BATCH_MAX_QUERIES = 100  # the server's MAX_BATCH_QUERIES; larger files are sent as several requests
+ADD_DOC_WORKERS = 8
+MMAP_UPLOAD_THRESHOLD = 1024 * 1024  # smaller files aren't worth the mapping setup
+USER_AGENT = "clausecompass-cli/1.0"
+CONFIG_DIR = Path("~/.clausecompass").expanduser()
+TOKEN_CACHE_PATH = CONFIG_DIR / "token.json"
+HISTORY_PATH = CONFIG_DIR / "history"
+RESPONSE_CACHE_PATH = CONFIG_DIR / "responses.sqlite3"
+RESPONSE_CACHE_TTL_SECONDS = 3600
+RESPONSE_CACHE_MAX_ENTRIES = 1000
+NO_CACHE_FLAG = "--no-cache"
+STRICT_SHELL_FLAG = "--strict-shell"
+TOKEN_EXPIRY_MARGIN_SECONDS = 30  # a cached token needs this much life left to be restored
+TOKEN_REFRESH_MARGIN_SECONDS = 5  # re-login locally this close to expiry instead of waiting for a 401
+DOC_INDEX_TTL_SECONDS = 60
+# Responses larger than this skip syntax highlighting; Pygments tokenizing dominates render time
+RESPONSE_HIGHLIGHT_LIMIT = 64 * 1024
+RESPONSE_PREVIEW_CHARS = 8192
 
 # --- Application State ---
 APP_STATE = {
     "token": None,
+    "token_exp": None,  # 'exp' claim of the token, read locally
     "user_email": None,
     "mode": "persistent",
     "persistent_docs_context": [],
-    "temp_docs_staged": [],
-    "temp_session_active": False
+    "temp_docs_staged": {},  # resolved Path -> (sha256, size, mtime_ns), insertion-ordered
+    "temp_session_active": False,
+    "temp_session_docs": [],  # sha256s of the documents behind the active temporary session
+    "doc_index": None,  # cached set of persistent KB document names
+    "doc_index_ts": 0,
+    "_rev": 0  # bumped by _mutate() on every state change; keys the prompt cache
 }
 
+def _mutate(**changes):
+    """Applies state changes and bumps the revision so cached views (the prompt) are rebuilt."""
+    APP_STATE.update(changes)
+    APP_STATE["_rev"] += 1
+
+# --- HTTP Session (connection pooling + keep-alive) ---
+# `requests` is imported on first network call so REPL startup doesn't pay for it.
+requests = None
+SESSION = None
+
+def _session():
+    """Returns the shared pooled Session, importing requests and building it on first use."""
+    global requests, SESSION
+    if SESSION is None:
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+        SESSION = requests.Session()
+        SESSION.mount(BASE_URL, HTTPAdapter(
+            pool_connections=4, pool_maxsize=8,
+            max_retries=Retry(total=2, backoff_factor=0.2, status_forcelist=[502, 503, 504]),
+        ))
+        if APP_STATE["token"]: SESSION.headers["Authorization"] = f"Bearer {APP_STATE['token']}"
+    return SESSION
+
+def _error_detail(body, default):
+    """FastAPI's 'detail' from an error body, or the raw text when the body isn't JSON (plain 500s, proxy pages)."""
+    try: detail = orjson.loads(body).get('detail', default)
+    except (orjson.JSONDecodeError, AttributeError): detail = body.decode("utf-8", errors="replace").strip()[:200] or default
+    return escape(str(detail))
+
+# Small JSON calls (login/register/list_docs) go straight to urllib3, skipping requests'
+# per-call preparation; the Session above stays for streamed uploads and queries.
+urllib3 = None
+POOL = None
+
+def _pool():
+    """Returns the shared urllib3 PoolManager, building it on first use."""
+    global urllib3, POOL
+    if POOL is None:
+        import urllib3
+        POOL = urllib3.PoolManager(
+            num_pools=2, maxsize=8,
+            retries=urllib3.Retry(total=2, backoff_factor=0.2, status_forcelist=[502, 503, 504], raise_on_status=False),
+            timeout=urllib3.Timeout(connect=REQUEST_TIMEOUT[0], read=REQUEST_TIMEOUT[1]),
+        )
+    return POOL
+
+def _pool_headers(content_type=None):
+    # urllib3 replaces rather than merges per-request headers, so build the full set each call
+    headers = {"User-Agent": USER_AGENT}
+    if APP_STATE["token"]: headers["Authorization"] = f"Bearer {APP_STATE['token']}"
+    if content_type: headers["Content-Type"] = content_type
+    return headers
+
+def _ensure_config_dir():
+    # Holds the bearer token and cached answers to the user's queries: keep it private to the user
+    CONFIG_DIR.mkdir(mode=0o700, parents=True, exist_ok=True)
+    os.chmod(CONFIG_DIR, 0o700)
+
+# --- Token Cache (survives CLI restarts) ---
+def _jwt_exp(token):
+    """Reads the 'exp' claim from a JWT without verifying it; the server still does that."""
+    payload = token.split('.')[1]
+    payload += '=' * (-len(payload) % 4)
+    return json.loads(base64.urlsafe_b64decode(payload))["exp"]
+
+def _set_token(token, email):
+    try: token_exp = _jwt_exp(token)
+    except (ValueError, KeyError, IndexError, TypeError): token_exp = None  # not a readable JWT; rely on the server's 401
+    _mutate(token=token, user_email=email, token_exp=token_exp)
+    if SESSION is not None: SESSION.headers["Authorization"] = f"Bearer {token}"
+
+def _save_token(token, email):
+    try:
+        _ensure_config_dir()
+        fd = os.open(TOKEN_CACHE_PATH, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f: json.dump({"token": token, "email": email, "exp": _jwt_exp(token), "server": BASE_URL}, f)
+        os.chmod(TOKEN_CACHE_PATH, 0o600)
+    except (OSError, ValueError, KeyError, IndexError): pass  # caching is best-effort
+
+def _load_cached_token():
+    """Restores a cached login if it was issued by BASE_URL and is not about to expire. Returns True on success."""
+    try:
+        cached = json.loads(TOKEN_CACHE_PATH.read_text())
+        # Never send one server's token to another; caches without a "server" field are ignored too
+        if cached.get("server") == BASE_URL and cached["exp"] > time.time() + TOKEN_EXPIRY_MARGIN_SECONDS:
+            _set_token(cached["token"], cached["email"])
+            return True
+    except (OSError, ValueError, KeyError, TypeError): pass
+    return False
+
+def _clear_token():
+    _mutate(token=None, user_email=None, token_exp=None)
+    if SESSION is not None: SESSION.headers.pop("Authorization", None)
+    try: TOKEN_CACHE_PATH.unlink()
+    except FileNotFoundError: pass
+
+# --- Response Cache (repeat queries are answered from disk) ---
+# `sqlite3` is imported when the cache is first opened, like `requests` above.
+sqlite3 = None
+_RESPONSE_CACHE = None
+
+def _response_cache():
+    global sqlite3, _RESPONSE_CACHE
+    if _RESPONSE_CACHE is None:
+        import sqlite3
+        _ensure_config_dir()
+        os.close(os.open(RESPONSE_CACHE_PATH, os.O_WRONLY | os.O_CREAT, 0o600))
+        os.chmod(RESPONSE_CACHE_PATH, 0o600)
+        _RESPONSE_CACHE = sqlite3.connect(RESPONSE_CACHE_PATH)
+        _RESPONSE_CACHE.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, body BLOB NOT NULL, expires REAL NOT NULL, accessed REAL NOT NULL)")
+    return _RESPONSE_CACHE
+
+def _response_cache_key(query, context):
+    """Keys a query by server, user, mode and the documents it runs against."""
+    import hashlib
+    return hashlib.blake2b(orjson.dumps([BASE_URL, APP_STATE["user_email"], APP_STATE["mode"], query, sorted(context)]), digest_size=16).hexdigest()
+
+def _cache_get(key):
+    try:
+        db = _response_cache()
+        row = db.execute("SELECT body FROM responses WHERE key = ? AND expires > ?", (key, time.time())).fetchone()
+        if row is None: return None
+        with db: db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (time.time(), key))
+        return orjson.loads(row[0])
+    except (OSError, sqlite3.Error, orjson.JSONDecodeError): return None  # caching is best-effort
+
+def _cache_set(key, data):
+    # Don't pin the server's fallback answer for a failed LLM parse
+    if data is None or (isinstance(data, dict) and data.get("Decision") == "Error"): return
+    now = time.time()
+    try:
+        db = _response_cache()
+        with db:
+            db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)", (key, orjson.dumps(data), now + RESPONSE_CACHE_TTL_SECONDS, now))
+            db.execute("DELETE FROM responses WHERE expires <= ? OR key NOT IN (SELECT key FROM responses ORDER BY accessed DESC LIMIT ?)", (now, RESPONSE_CACHE_MAX_ENTRIES))
+    except (OSError, sqlite3.Error, TypeError): pass
+
+def _reauthenticate():
+    """Drops a token the server rejected and prompts for login. Returns True if a new token was obtained."""
+    console.print("[bold yellow]Your session has expired. Please log in again.[/bold yellow]")
+    _clear_token()
+    handle_login("")
+    return APP_STATE["token"] is not None
+
+def _require_login():
+    """Returns True if there is a usable token. A token that has expired locally triggers
+    a login prompt right away instead of a request that would only come back 401."""
+    token_exp = APP_STATE["token_exp"]
+    if APP_STATE["token"] and token_exp is not None and time.time() >= token_exp - TOKEN_REFRESH_MARGIN_SECONDS:
+        _reauthenticate()
+    return APP_STATE["token"] is not None
+
 # --- Rich Console ---
 console = Console()
 
 # --- Command Handler Functions ---
 
+_HELP_RENDERABLE = None  # built on first 'help'; the layout never changes
+
+# A double-quoted (backslash escapes allowed), single-quoted or bare argument
+_ARG_TOKEN_RE = re.compile(r'"([^"\\]*(?:\\.[^"\\]*)*)"|\'([^\']*)\'|(\S+)')
+# POSIX double quotes only unescape \" and \\, so quoted Windows paths keep their backslashes
+_ARG_ESCAPE_RE = re.compile(r'\\([\\"])')
+
+def _split_args(args_str):
+    """Splits space-separated, optionally quoted arguments in a single regex pass.
+    Quotes only delimit whole arguments: unlike shlex, foo"bar baz" is two tokens, not 'foobar baz'.
+    A leading --strict-shell falls back to full POSIX shell rules via shlex for such input."""
+    args_str = args_str.strip()
+    if args_str == STRICT_SHELL_FLAG or args_str.startswith(STRICT_SHELL_FLAG + " "):
+        import shlex
+        return shlex.split(args_str[len(STRICT_SHELL_FLAG):])
+    # Exactly one group matches per token; lastindex says which alternative it was
+    return [_ARG_ESCAPE_RE.sub(r'\1', m.group(1)) if m.lastindex == 1 else m.group(m.lastindex) for m in _ARG_TOKEN_RE.finditer(args_str)]
+
 def handle_help(*args):
     """Displays the comprehensive help message for both modes."""
-    console.print(Panel("[bold]ClauseCompass Decision Engine CLI[/bold] 🧭", subtitle="A tool for querying the RAG system.", border_style="blue"))
-    table = Table(title="Core Commands", show_header=False, box=None)
-    table.add_row("[bold cyan]mode [persistent|temporary][/bold cyan]", "Switch between modes. This clears any set document context.")
-    table.add_row("[bold cyan]login / register / logout[/bold cyan]", "Standard user session management.")
-    table.add_row("[bold cyan]help[/bold cyan]", "Show this help message.")
-    table.add_row("[bold cyan]exit / quit[/bold cyan]", "Exit the application.")
-    console.print(table)
-    
-    console.print("\n[bold]Persistent Mode Commands:[/bold] (Query the pre-loaded server knowledge base)")
-    table_p = Table(show_header=False, box=None)
-    table_p.add_row("[bold cyan]list_docs[/bold cyan]", "List available documents in the persistent KB.")
-    table_p.add_row("[bold cyan]set_docs [file1.pdf]...[/bold cyan]", "Set server-side document context for queries.")
-    console.print(table_p)
-
-    console.print("\n[bold]Temporary Mode Commands:[/bold] (Create a temporary session with your own documents)")
-    table_t = Table(show_header=False, box=None)
-    table_t.add_row("[bold cyan]add_doc /path/to/file.pdf[/bold cyan]", "Stage a local document for upload.")
-    table_t.add_row("[bold cyan]upload_docs[/bold cyan]", "Upload staged documents to start a new temporary session.")
-    table_t.add_row("[bold cyan]show_docs[/bold cyan]", "Show currently staged documents or active context.")
-    table_t.add_row("[bold cyan]clear_docs[/bold cyan]", "Clear staged documents or active context.")
-    console.print(table_t)
-    
-    console.print("\n[bold]Querying:[/bold]")
-    console.print("Simply type your query and press Enter. The right action will be taken based on the current mode.")
+    global _HELP_RENDERABLE
+    if _HELP_RENDERABLE is None:
+        header = Panel("[bold]ClauseCompass Decision Engine CLI[/bold] 🧭", subtitle="A tool for querying the RAG system.", border_style="blue")
+        table = Table(title="Core Commands", show_header=False, box=None)
+        table.add_row("[bold cyan]mode [persistent|temporary][/bold cyan]", "Switch between modes. This clears any set document context.")
+        table.add_row("[bold cyan]login / register / logout[/bold cyan]", "Standard user session management.")
+        table.add_row("[bold cyan]clear_cache[/bold cyan]", "Forget cached query responses.")
+        table.add_row("[bold cyan]run /path/to/script.txt[/bold cyan]", "Replay a file of commands and queries, one per line.")
+        table.add_row("[bold cyan]help[/bold cyan]", "Show this help message.")
+        table.add_row("[bold cyan]exit / quit[/bold cyan]", "Exit the application.")
+
+        table_p = Table(show_header=False, box=None)
+        table_p.add_row("[bold cyan]list_docs[/bold cyan]", "List available documents in the persistent KB.")
+        table_p.add_row("[bold cyan]set_docs [file1.pdf]...[/bold cyan]", "Set server-side document context for queries.")
+        table_p.add_row("[bold cyan]batch queries.txt \\[results.ndjson][/bold cyan]", "Run one query per line in a single request; optionally save results.")
+
+        table_t = Table(show_header=False, box=None)
+        table_t.add_row("[bold cyan]add_doc /path/to/file.pdf[/bold cyan]", "Stage a local document for upload.")
+        table_t.add_row("[bold cyan]upload_docs[/bold cyan]", "Upload staged documents to start a new temporary session.")
+        table_t.add_row("[bold cyan]show_docs[/bold cyan]", "Show currently staged documents or active context.")
+        table_t.add_row("[bold cyan]clear_docs[/bold cyan]", "Clear staged documents or active context.")
+
+        _HELP_RENDERABLE = Group(
+            header, table,
+            Text.from_markup("\n[bold]Persistent Mode Commands:[/bold] (Query the pre-loaded server knowledge base)"), table_p,
+            Text.from_markup("\n[bold]Temporary Mode Commands:[/bold] (Create a temporary session with your own documents)"), table_t,
+            Text.from_markup("\n[bold]Querying:[/bold]"),
+            Text("Simply type your query and press Enter. The right action will be taken based on the current mode."),
+            Text.from_markup(f"Repeat queries are answered from a local cache for an hour; prefix a query with [bold cyan]{NO_CACHE_FLAG}[/bold cyan] to bypass it."),
+        )
+    console.print(_HELP_RENDERABLE)
 
 
 def handle_mode_switch(args_str):
     """Switches the application mode and clears contexts."""
     new_mode = args_str.strip().lower()
     if new_mode in ["persistent", "temporary"]:
-        APP_STATE["mode"] = new_mode
+        _mutate(mode=new_mode, persistent_docs_context=[], temp_docs_staged={}, temp_session_active=False)
         console.print(f"[bold green]✔ Mode switched to: {new_mode}[/bold green]")
-        APP_STATE["persistent_docs_context"] = []
-        APP_STATE["temp_docs_staged"] = []
-        APP_STATE["temp_session_active"] = False
     else:
         console.print("[bold red]❌ Invalid mode. Use 'persistent' or 'temporary'.[/bold red]")
 
 def handle_login(args_str):
     email = console.input("[bold]Email: [/bold]")
     password = console.input("[bold]Password: [/bold]", password=True)
+    pool = _pool()
     try:
-        response = requests.post(f"{BASE_URL}/login", data={"username": email, "password": password})
-        if response.status_code == 200:
-            APP_STATE["token"] = response.json()["access_token"]
-            APP_STATE["user_email"] = email
+        response = pool.request("POST", f"{BASE_URL}/login", fields={"username": email, "password": password}, encode_multipart=False, headers=_pool_headers())
+        if response.status == 200:
+            _set_token(orjson.loads(response.data)["access_token"], email)
+            _save_token(APP_STATE["token"], email)
             console.print("[bold green]✔ Login successful.[/bold green]")
         else:
-            console.print(f"[bold red]❌ Login failed: {response.json().get('detail', 'Invalid credentials')}[/bold red]")
-    except requests.exceptions.RequestException: console.print(f"[bold red]Connection Error to API at {BASE_URL}.[/bold red]")
+            console.print(f"[bold red]❌ Login failed: {_error_detail(response.data, 'Invalid credentials')}[/bold red]")
+    except urllib3.exceptions.HTTPError: console.print(f"[bold red]Connection Error to API at {BASE_URL}.[/bold red]")
+    except (orjson.JSONDecodeError, KeyError, TypeError): console.print("[bold red]❌ Login failed: The server returned a malformed response.[/bold red]")
 
 def handle_register(args_str):
     userid = console.input("[bold]Enter new User ID: [/bold]")
     email = console.input("[bold]Enter your Email: [/bold]")
     password = console.input("[bold]Enter Password: [/bold]", password=True)
-    response = requests.post(f"{BASE_URL}/register", json={"userid": userid, "emailid": email, "password": password})
-    if response.status_code == 200: console.print("[bold green]✔ Registration successful. Please login.[/bold green]")
-    else: console.print(f"[bold red]❌ Registration failed: {response.json().get('detail', 'Unknown error')}[/bold red]")
+    pool = _pool()
+    try:
+        response = pool.request("POST", f"{BASE_URL}/register", body=orjson.dumps({"userid": userid, "emailid": email, "password": password}), headers=_pool_headers("application/json"))
+        if response.status == 200: console.print("[bold green]✔ Registration successful. Please login.[/bold green]")
+        else: console.print(f"[bold red]❌ Registration failed: {_error_detail(response.data, 'Unknown error')}[/bold red]")
+    except urllib3.exceptions.HTTPError: console.print(f"[bold red]Connection Error to API at {BASE_URL}.[/bold red]")
 
 def handle_logout(*args):
-    APP_STATE["token"], APP_STATE["user_email"], APP_STATE["persistent_docs_context"], APP_STATE["temp_docs_staged"] = None, None, [], []
-    APP_STATE["temp_session_active"] = False
+    _clear_token()
+    _mutate(persistent_docs_context=[], temp_docs_staged={}, temp_session_active=False, doc_index=None, doc_index_ts=0)
     console.print("[bold yellow]You have been logged out.[/bold yellow]")
 
+def _refresh_doc_index():
+    """Returns the set of persistent KB documents, re-fetching /documents once the cached copy is older
+    than DOC_INDEX_TTL_SECONDS. On a failed fetch the error is printed and the stale copy (or None) is returned."""
+    if APP_STATE["doc_index"] is not None and time.time() - APP_STATE["doc_index_ts"] < DOC_INDEX_TTL_SECONDS:
+        return APP_STATE["doc_index"]
+    pool = _pool()
+    try:
+        response = pool.request("GET", f"{BASE_URL}/documents", headers=_pool_headers())
+    except urllib3.exceptions.HTTPError: console.print(f"[bold red]Connection Error.[/bold red]"); return APP_STATE["doc_index"]
+    if response.status != 200:
+        console.print(f"[bold red]Error fetching documents: {_error_detail(response.data, 'Unknown error')}[/bold red]")
+        return APP_STATE["doc_index"]
+    try: documents = orjson.loads(response.data).get("documents", [])
+    except (orjson.JSONDecodeError, AttributeError):
+        console.print("[bold red]Error fetching documents: The server returned a malformed response.[/bold red]")
+        return APP_STATE["doc_index"]
+    _mutate(doc_index=frozenset(documents), doc_index_ts=time.time())
+    return APP_STATE["doc_index"]
+
 def handle_list_docs(*args):
     if APP_STATE["mode"] != 'persistent': console.print("[bold red]This command is only available in 'persistent' mode.[/bold red]"); return
-    if not APP_STATE["token"]: console.print("[bold red]You must be logged in first.[/bold red]"); return
-    headers = {"Authorization": f"Bearer {APP_STATE['token']}"}
-    response = requests.get(f"{BASE_URL}/documents", headers=headers)
-    if response.status_code == 200:
-        docs = response.json().get("documents", [])
-        if not docs: console.print("[yellow]No documents found in persistent KB.[/yellow]"); return
-        table = Table("Available Documents in Persistent KB")
-        for doc in sorted(docs): table.add_row(doc)
-        console.print(table)
-    else: console.print(f"[bold red]Error fetching documents: {response.json().get('detail', 'Unknown error')}[/bold red]")
+    if not _require_login(): console.print("[bold red]You must be logged in first.[/bold red]"); return
+    docs = _refresh_doc_index()
+    if docs is None: return
+    if not docs: console.print("[yellow]No documents found in persistent KB.[/yellow]"); return
+    table = Table("Available Documents in Persistent KB")
+    for doc in sorted(docs): table.add_row(doc)
+    console.print(table)
 
 def handle_set_docs(args_str):
     if APP_STATE["mode"] != 'persistent': console.print("[bold red]This command is only available in 'persistent' mode.[/bold red]"); return
-    if not args_str or args_str.strip() == '*': APP_STATE["persistent_docs_context"] = []; console.print("[bold yellow]Persistent document context cleared.[/bold yellow]"); return
-    APP_STATE["persistent_docs_context"] = shlex.split(args_str)
-    console.print(f"[bold yellow]Persistent document context set to: {APP_STATE['persistent_docs_context']}[/bold yellow]")
+    if not args_str or args_str.strip() == '*': _mutate(persistent_docs_context=[]); console.print("[bold yellow]Persistent document context cleared.[/bold yellow]"); return
+    requested_docs = _split_args(args_str)
+    # Validate against the KB locally so a typo doesn't cost a full /evaluate round-trip
+    known_docs = _refresh_doc_index() if APP_STATE["token"] and _require_login() else None
+    if known_docs is None:
+        if APP_STATE["token"]: console.print("[yellow]Could not fetch the document list; names were not validated.[/yellow]")
+    else:
+        unknown_docs = [doc for doc in requested_docs if doc not in known_docs]
+        if unknown_docs:
+            table = Table("Unknown Document", "Did you mean", title="Document context not changed")
+            for doc in unknown_docs: table.add_row(f"[red]{escape(doc)}[/red]", escape(", ".join(difflib.get_close_matches(doc, known_docs))) or "-")
+            console.print(table); return
+    _mutate(persistent_docs_context=requested_docs)
+    console.print(f"[bold yellow]Persistent document context set to: {escape(str(APP_STATE['persistent_docs_context']))}[/bold yellow]")
+
+def _file_sha256(file_path):
+    import hashlib
+    with open(file_path, 'rb') as f:
+        if hasattr(hashlib, "file_digest"): return hashlib.file_digest(f, "sha256").hexdigest()  # Python 3.11+
+        digest = hashlib.sha256()
+        for block in iter(lambda: f.read(1 << 20), b""): digest.update(block)
+        return digest.hexdigest()
+
+def _resolve_staged_candidate(file_path):
+    """Returns (path, stat_result, error) for one add_doc argument; runs on a worker thread."""
+    try: path = Path(file_path).expanduser().resolve(strict=True)  # validates and canonicalizes in one pass
+    except (OSError, RuntimeError): return None, None, "File not found"
+    try: file_stat = path.stat()
+    except OSError as e: return None, None, e.strerror or str(e)
+    if not stat.S_ISREG(file_stat.st_mode): return None, None, "Not a file"
+    return path, file_stat, None
+
+def _try_file_sha256(path):
+    try: return _file_sha256(path)
+    except OSError: return None
+
+def _refresh_staged_digests(staged):
+    """Re-hashes staged files whose size or mtime changed since add_doc, so uploads and the
+    session's cache key match what is on disk now. Returns the paths that can no longer be read."""
+    unreadable = []
+    for path, (digest, size, mtime_ns) in staged.items():
+        try: file_stat = path.stat()
+        except OSError: unreadable.append(path); continue
+        if (file_stat.st_size, file_stat.st_mtime_ns) == (size, mtime_ns): continue
+        digest = _try_file_sha256(path)
+        if digest is None: unreadable.append(path)
+        else: staged[path] = (digest, file_stat.st_size, file_stat.st_mtime_ns)
+    return unreadable
 
 def handle_add_doc(args_str):
     if APP_STATE["mode"] != 'temporary': console.print("[bold red]This command is only available in 'temporary' mode.[/bold red]"); return
     if not args_str: console.print("[bold red]Usage: add_doc /path/to/file.pdf ...[/bold red]"); return
-    files_to_add = shlex.split(args_str)
-    for file_path in files_to_add:
-        if os.path.exists(file_path) and os.path.isfile(file_path):
-            abs_path = os.path.abspath(file_path)
-            if abs_path not in APP_STATE["temp_docs_staged"]: APP_STATE["temp_docs_staged"].append(abs_path); console.print(f"[green]Staged:[/green] {abs_path}")
-            else: console.print(f"[yellow]Skipped (already staged):[/yellow] {abs_path}")
-        else: console.print(f"[bold red]Error: File not found:[/bold red] {file_path}")
+    staged = APP_STATE["temp_docs_staged"]
+    file_paths = _split_args(args_str)
+    if not file_paths: console.print("[bold red]Usage: add_doc /path/to/file.pdf ...[/bold red]"); return
+    from concurrent.futures import ThreadPoolExecutor
+    # stat() and hashing block on disk I/O (and hashlib releases the GIL), so a wide glob on a
+    # slow or network mount is validated concurrently rather than one syscall at a time
+    with ThreadPoolExecutor(max_workers=min(ADD_DOC_WORKERS, len(file_paths))) as executor:
+        resolved = list(executor.map(_resolve_staged_candidate, file_paths))
+        new_paths = list(dict.fromkeys(path for path, _, _ in resolved if path is not None and path not in staged))
+        digests = dict(zip(new_paths, executor.map(_try_file_sha256, new_paths)))
+
+    table = Table(show_header=False, box=None)
+    for file_path, (path, file_stat, error) in zip(file_paths, resolved):
+        if error: table.add_row(f"[bold red]Error: {error}[/bold red]", escape(file_path))
+        elif path in staged: table.add_row("[yellow]Skipped (already staged)[/yellow]", escape(str(path)))
+        elif digests[path] is None: table.add_row("[bold red]Error: Could not read file[/bold red]", escape(file_path))
+        else:
+            staged[path] = (digests[path], file_stat.st_size, file_stat.st_mtime_ns)
+            table.add_row("[green]Staged[/green]", escape(str(path)))
+    _mutate()
+    console.print(table)
 
 def handle_show_docs(*args):
     title = ""
@@ -133,84 +427,222 @@ def handle_show_docs(*args):
         docs_list = APP_STATE["persistent_docs_context"]
     else:
         title = "Local Documents Staged for Upload"
-        docs_list = APP_STATE["temp_docs_staged"]
+        docs_list = [str(path) for path in APP_STATE["temp_docs_staged"]]
     if not docs_list: console.print(f"[yellow]No documents are currently set for this mode.[/yellow]"); return
     table = Table(title)
     for doc in docs_list: table.add_row(doc)
     console.print(table)
     
+def handle_clear_cache(*args):
+    try:
+        with _response_cache() as db: db.execute("DELETE FROM responses")
+        console.print("[bold yellow]Cached query responses have been cleared.[/bold yellow]")
+    except (OSError, sqlite3.Error) as e: console.print(f"[bold red]Could not clear the response cache:[/bold red] {e}")
+
 def handle_clear_docs(*args):
-    if APP_STATE["mode"] == 'persistent': APP_STATE["persistent_docs_context"] = []
-    else: APP_STATE["temp_docs_staged"] = []
-    APP_STATE["temp_session_active"] = False
+    if APP_STATE["mode"] == 'persistent': _mutate(persistent_docs_context=[], temp_session_active=False)
+    else: _mutate(temp_docs_staged={}, temp_session_active=False)
     console.print("[bold yellow]Current document context has been cleared.[/bold yellow]")
 
 def handle_upload_docs(*args):
     if APP_STATE["mode"] != 'temporary': console.print("[bold red]This command is only available in 'temporary' mode.[/bold red]"); return
-    if not APP_STATE["token"]: console.print("[bold red]You must be logged in first.[/bold red]"); return
+    if not _require_login(): console.print("[bold red]You must be logged in first.[/bold red]"); return
     if not APP_STATE["temp_docs_staged"]: console.print("[bold red]No documents staged. Use 'add_doc' to stage files first.[/bold red]"); return
 
-    headers = {"Authorization": f"Bearer {APP_STATE['token']}"}
-    files_payload = []; file_handles = []
+    staged = APP_STATE["temp_docs_staged"]
+    unreadable = _refresh_staged_digests(staged)
+    if unreadable:
+        for path in unreadable: console.print(f"[bold red]Error: Could not read staged file[/bold red] {escape(str(path))}")
+        console.print("[bold red]Upload cancelled. Use 'clear_docs' and 'add_doc' to re-stage.[/bold red]"); return
+
+    http = _session()
     try:
-        for file_path in APP_STATE["temp_docs_staged"]:
-            handle = open(file_path, 'rb'); file_handles.append(handle)
-            files_payload.append(('files', (os.path.basename(file_path), handle)))
+        # Ask which documents the server already has processed, so unchanged files aren't sent again
+        precheck = http.post(f"{BASE_URL}{SESSION_PRECHECK_ENDPOINT}", json={"hashes": [digest for digest, *_ in staged.values()]}, timeout=REQUEST_TIMEOUT)
+        try: missing = set(orjson.loads(precheck.content)["missing"]) if precheck.status_code == 200 else None
+        except (orjson.JSONDecodeError, KeyError, TypeError): missing = None
+        if missing is None: missing = {digest for digest, *_ in staged.values()}
         
-        console.print(f"Uploading {len(files_payload)} document(s) to start new session...")
+        uploading = sum(1 for digest, *_ in staged.values() if digest in missing)
+        console.print(f"Uploading {uploading} of {len(staged)} document(s) to start new session...")
         with console.status("[bold green]Processing documents on server...[/bold green]"):
-            response = requests.post(f"{BASE_URL}{SESSION_UPLOAD_ENDPOINT}", headers=headers, files=files_payload)
+            response = _post_staged_docs(http, staged, missing)
+            # The server evicted a document between precheck and upload; send everything
+            if response.status_code == 409: response = _post_staged_docs(http, staged, {digest for digest, *_ in staged.values()})
         
         if response.status_code == 200:
-            console.print(f"[bold green]✔ {response.json().get('message', 'Session created.')}[/bold green]")
-            APP_STATE["temp_session_active"] = True
-            APP_STATE["temp_docs_staged"] = []
+            try: message = orjson.loads(response.content).get('message', 'Session created.')
+            except (orjson.JSONDecodeError, AttributeError): message = 'Session created.'
+            console.print(f"[bold green]✔ {escape(str(message))}[/bold green]")
+            _mutate(temp_session_active=True, temp_session_docs=[digest for digest, *_ in staged.values()], temp_docs_staged={})
         else:
-            console.print(f"[bold red]Error: {response.status_code} - {response.json().get('detail', 'Upload failed.')}[/bold red]")
+            console.print(f"[bold red]Error: {response.status_code} - {_error_detail(response.content, 'Upload failed.')}[/bold red]")
     except requests.exceptions.RequestException: console.print(f"[bold red]Connection Error.[/bold red]")
+    except orjson.JSONDecodeError: console.print("[bold red]Error: The server returned a malformed response.[/bold red]")
+
+class _MappedFile:
+    """Read-only mmap of a file, exposing the read()/len interface MultipartEncoder streams from.
+    (A bare mmap won't do: its __len__ never shrinks as it is read, so the encoder would never finish.)"""
+    def __init__(self, file_path):
+        with open(file_path, 'rb') as f: self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @property
+    def len(self): return len(self._map) - self._map.tell()
+
+    def read(self, size=-1): return self._map.read(size)
+
+    def close(self): self._map.close()
+
+def _post_staged_docs(http, staged, missing):
+    """Uploads the staged files whose hash is in `missing` and references the rest by hash."""
+    # MultipartEncoder streams each file from disk as the body is sent, instead of
+    # requests' files= which reads every file fully into memory first.
+    from requests_toolbelt.multipart.encoder import MultipartEncoder
+    fields = []; file_handles = []
+    try:
+        for file_path, (digest, size, _) in staged.items():
+            if digest not in missing: fields.extend([('cached_hashes', digest), ('cached_filenames', file_path.name)]); continue
+            # Large files are read straight out of the page cache instead of through a buffered file object
+            handle = _MappedFile(file_path) if size >= MMAP_UPLOAD_THRESHOLD else open(file_path, 'rb')
+            file_handles.append(handle)
+            content_type = mimetypes.guess_type(file_path)[0] or "application/octet-stream"
+            fields.append(('files', (file_path.name, handle, content_type)))
+        encoder = MultipartEncoder(fields=fields)
+        return http.post(f"{BASE_URL}{SESSION_UPLOAD_ENDPOINT}", data=encoder, headers={"Content-Type": encoder.content_type}, timeout=UPLOAD_TIMEOUT)
     finally:
         for handle in file_handles: handle.close()
 
 def handle_query(query_text):
-    if not APP_STATE["token"]: console.print("[bold red]You must be logged in to run a query.[/bold red]"); return
+    if not _require_login(): console.print("[bold red]You must be logged in to run a query.[/bold red]"); return
+    use_cache = not query_text.startswith(NO_CACHE_FLAG)
+    if not use_cache: query_text = query_text[len(NO_CACHE_FLAG):].strip()
+    if not query_text: return
     if APP_STATE["mode"] == 'persistent':
-        handle_persistent_query(query_text)
+        handle_persistent_query(query_text, use_cache=use_cache)
     else:
-        handle_temporary_query(query_text)
+        handle_temporary_query(query_text, use_cache=use_cache)
 
 # --- CORRECTED FUNCTION ---
-def handle_persistent_query(query):
-    headers = {"Authorization": f"Bearer {APP_STATE['token']}"}
+def handle_persistent_query(query, retry_auth=True, use_cache=True):
     # Match the Pydantic model 'QueryRequest' in app.py
     payload = {"query_text": query, "source_files": APP_STATE["persistent_docs_context"]}
+    cache_key = _response_cache_key(query, APP_STATE["persistent_docs_context"])
+    if use_cache and (cached := _cache_get(cache_key)) is not None: display_structured_response(cached); return
+    http = _session()
     try:
         with console.status("[bold green]Querying persistent KB...[/bold green]"):
             # Use the correct endpoint for persistent queries
-            response = requests.post(f"{BASE_URL}{PERSISTENT_ENDPOINT}", headers=headers, json=payload)
-        if response.status_code == 200: display_structured_response(response.json())
-        else: console.print(f"[bold red]Error: {response.status_code} - {response.json().get('detail', 'Unknown error')}[/bold red]")
+            response = http.post(f"{BASE_URL}{PERSISTENT_ENDPOINT}", json=payload, timeout=QUERY_TIMEOUT)
+        if response.status_code == 401 and retry_auth and _reauthenticate(): return handle_persistent_query(query, retry_auth=False, use_cache=use_cache)
+        if response.status_code == 200:
+            data = orjson.loads(response.content)
+            display_structured_response(data)
+            _cache_set(cache_key, data)
+        else: console.print(f"[bold red]Error: {response.status_code} - {_error_detail(response.content, 'Unknown error')}[/bold red]")
     except requests.exceptions.RequestException: console.print(f"[bold red]Connection Error.[/bold red]")
+    except orjson.JSONDecodeError: console.print("[bold red]Error: The server returned a malformed response.[/bold red]")
 
-def handle_temporary_query(query):
+def handle_temporary_query(query, retry_auth=True, use_cache=True):
     if not APP_STATE["temp_session_active"]: console.print("[bold red]No active temporary session. Use 'add_doc' and 'upload_docs' first.[/bold red]"); return
     
-    headers = {"Authorization": f"Bearer {APP_STATE['token']}"}
     # Match the Pydantic model 'QueryRequest' for the session query endpoint
     payload = {"query_text": query} # source_files not needed here
+    cache_key = _response_cache_key(query, APP_STATE["temp_session_docs"])
+    if use_cache and (cached := _cache_get(cache_key)) is not None: display_structured_response(cached); return
+    http = _session()
     try:
         with console.status("[bold green]Querying temporary session...[/bold green]"):
-            response = requests.post(f"{BASE_URL}{SESSION_QUERY_ENDPOINT}", headers=headers, json=payload)
+            response = http.post(f"{BASE_URL}{SESSION_QUERY_ENDPOINT}", json=payload, timeout=QUERY_TIMEOUT)
         
-        if response.status_code == 200: display_structured_response(response.json())
-        else: console.print(f"[bold red]Error: {response.status_code} - {response.json().get('detail', 'Unknown error')}[/bold red]")
+        if response.status_code == 401 and retry_auth and _reauthenticate(): return handle_temporary_query(query, retry_auth=False, use_cache=use_cache)
+        if response.status_code == 200:
+            data = orjson.loads(response.content)
+            display_structured_response(data)
+            _cache_set(cache_key, data)
+        else: console.print(f"[bold red]Error: {response.status_code} - {_error_detail(response.content, 'Unknown error')}[/bold red]")
     except requests.exceptions.RequestException: console.print(f"[bold red]Connection Error.[/bold red]")
+    except orjson.JSONDecodeError: console.print("[bold red]Error: The server returned a malformed response.[/bold red]")
 
 def display_structured_response(data):
     try:
-        json_str = json.dumps(data, indent=2)
-        syntax = Syntax(json_str, "json", theme="solarized-dark", line_numbers=True)
-        console.print(Panel(syntax, title="AI Decision Engine Response", border_style="magenta", title_align="left"))
-    except (json.JSONDecodeError, TypeError): console.print(Panel(str(data), title="AI Response (Raw)", border_style="magenta"))
+        json_str = orjson.dumps(data, option=orjson.OPT_INDENT_2).decode()
+    except TypeError: console.print(Panel(str(data), title="AI Response (Raw)", border_style="magenta")); return
+    if len(json_str) > RESPONSE_HIGHLIGHT_LIMIT:
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", prefix="clausecompass-", suffix=".json", delete=False) as f: f.write(json_str)
+        console.print(Panel(Text(json_str[:RESPONSE_PREVIEW_CHARS] + "\n…truncated…"), title="AI Decision Engine Response", border_style="magenta", title_align="left"))
+        console.print(f"[yellow]Response is {len(json_str):,} characters; full body saved to {f.name}[/yellow]")
+        return
+    from rich.syntax import Syntax  # pulls in pygments; only needed once a response arrives
+    syntax = Syntax(json_str, "json", theme="solarized-dark", line_numbers=True)
+    console.print(Panel(syntax, title="AI Decision Engine Response", border_style="magenta", title_align="left"))
+
+def _post_batch(http, queries, docs_context, first, total):
+    body = b"\n".join(orjson.dumps({"query_text": query, "source_files": docs_context}) for query in queries)
+    with console.status(f"[bold green]Running queries {first + 1}-{first + len(queries)} of {total} against persistent KB...[/bold green]"):
+        return http.post(f"{BASE_URL}{BATCH_ENDPOINT}", data=body, headers={"Content-Type": "application/x-ndjson"}, stream=True, timeout=QUERY_TIMEOUT)
+
+def handle_batch(args_str):
+    """Sends every non-blank line of a file as a query, in NDJSON requests of up to BATCH_MAX_QUERIES,
+    and shows results as they stream back."""
+    if APP_STATE["mode"] != 'persistent': console.print("[bold red]This command is only available in 'persistent' mode.[/bold red]"); return
+    args = _split_args(args_str)
+    if not args or len(args) > 2: console.print("[bold red]Usage: batch queries.txt \\[results.ndjson][/bold red]"); return
+    if not _require_login(): console.print("[bold red]You must be logged in first.[/bold red]"); return
+    try: queries = [line.strip() for line in Path(args[0]).read_text(encoding="utf-8").splitlines() if line.strip()]
+    except OSError as e: console.print(f"[bold red]Error reading queries:[/bold red] {e}"); return
+    if not queries: console.print("[yellow]No queries found in file.[/yellow]"); return
+
+    docs_context = APP_STATE["persistent_docs_context"]
+    http = _session()
+    output = None
+    retry_auth = True
+    completed = 0
+    try:
+        for first in range(0, len(queries), BATCH_MAX_QUERIES):
+            chunk = queries[first:first + BATCH_MAX_QUERIES]
+            response = _post_batch(http, chunk, docs_context, first, len(queries))
+            if response.status_code == 401 and retry_auth and _reauthenticate():
+                retry_auth = False
+                response.close()
+                response = _post_batch(http, chunk, docs_context, first, len(queries))
+            with response:
+                if response.status_code != 200: console.print(f"[bold red]Error: {response.status_code} - {_error_detail(response.content, 'Unknown error')}[/bold red]"); return
+                if output is None and len(args) > 1: output = open(args[1], 'wb')
+                for line in response.iter_lines():
+                    if not line: continue
+                    result = orjson.loads(line)
+                    _cache_set(_response_cache_key(result["query_text"], docs_context), result["response"])
+                    completed += 1
+                    if output: output.write(line + b"\n"); console.print(f"[green]✔ {completed}/{len(queries)}[/green] {escape(result['query_text'])}")
+                    else: console.print(f"\n[bold]Query {completed}/{len(queries)}:[/bold] {escape(result['query_text'])}"); display_structured_response(result["response"])
+        if output: console.print(f"[bold green]✔ Results written to {escape(args[1])}[/bold green]")
+    except requests.exceptions.RequestException: console.print(f"[bold red]Connection Error.[/bold red]")  # before OSError, which it subclasses
+    except OSError as e: console.print(f"[bold red]Error writing results:[/bold red] {e}")
+    except (orjson.JSONDecodeError, KeyError, TypeError): console.print("[bold red]Error: The server returned a malformed batch result.[/bold red]")
+    finally:
+        if output: output.close()
+
+_RUNNING_SCRIPTS = set()  # resolved paths of scripts currently being replayed; guards against `run` recursion
+
+def handle_run_script(args_str):
+    """Replays a script of CLI input (one command or query per line, '#' for comments) in this session."""
+    script_path = args_str.strip()
+    if not script_path: console.print("[bold red]Usage: run /path/to/script.txt[/bold red]"); return
+    resolved = Path(script_path).expanduser().resolve()
+    if resolved in _RUNNING_SCRIPTS: console.print(f"[bold red]Error: {escape(script_path)} is already running; scripts cannot run themselves.[/bold red]"); return
+    _RUNNING_SCRIPTS.add(resolved)
+    try:
+        with open(resolved, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0: return  # mmap can't map an empty file
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for line_no, raw_line in enumerate(iter(mm.readline, b""), 1):
+                    line = raw_line.decode("utf-8").strip()
+                    if not line or line.startswith('#'): continue
+                    console.print(f"[dim]> {escape(line)}[/dim]")
+                    dispatch(line)
+    except UnicodeDecodeError: console.print(f"[bold red]Error reading script:[/bold red] line {line_no} is not valid UTF-8.")
+    except OSError as e: console.print(f"[bold red]Error reading script:[/bold red] {e}")
+    finally: _RUNNING_SCRIPTS.discard(resolved)
 
 COMMANDS = {
     "help": handle_help, "mode": handle_mode_switch,
@@ -218,10 +650,16 @@ COMMANDS = {
     "list_docs": handle_list_docs, "set_docs": handle_set_docs,
     "add_doc": handle_add_doc, "upload_docs": handle_upload_docs,
     "show_docs": handle_show_docs, "clear_docs": handle_clear_docs,
+    "clear_cache": handle_clear_cache,
+    "batch": handle_batch, "run": handle_run_script,
     "exit": lambda *args: exit(), "quit": lambda *args: exit(),
 }
 
+_PROMPT_CACHE = (None, "")  # (APP_STATE revision, prompt string)
+
 def get_current_prompt():
+    global _PROMPT_CACHE
+    if _PROMPT_CACHE[0] == APP_STATE["_rev"]: return _PROMPT_CACHE[1]
     user_part = APP_STATE.get("user_email", "logged out")
     mode_part = f" ({APP_STATE['mode']})"
     context_part = ""
@@ -236,23 +674,59 @@ def get_current_prompt():
         elif num_staged > 0:
             context_part = f" [{num_staged} doc{'s' if num_staged > 1 else ''} staged]"
             
-    return f"ClauseCompass{mode_part} ({user_part}){context_part} > "
+    _PROMPT_CACHE = (APP_STATE["_rev"], f"ClauseCompass{mode_part} ({user_part}){context_part} > ")
+    return _PROMPT_CACHE[1]
+
+def dispatch(user_input):
+    command, _, args = user_input.partition(' ')
+    handler = COMMANDS.get(command.lower())
+    if handler: handler(args)
+    else: handle_query(user_input)
+
+def _build_prompt_session():
+    """Returns a prompt_toolkit session with history and completion, or None to fall back to console.input."""
+    if not sys.stdin.isatty(): return None
+    try:
+        from prompt_toolkit import PromptSession
+        from prompt_toolkit.completion import Completer, WordCompleter, PathCompleter
+        from prompt_toolkit.document import Document
+        from prompt_toolkit.history import FileHistory
+    except ImportError: return None
+
+    class CommandCompleter(Completer):
+        command_completer = WordCompleter(list(COMMANDS), ignore_case=True)
+        mode_completer = WordCompleter(["persistent", "temporary"])
+        path_completer = PathCompleter(expanduser=True)
+
+        def get_completions(self, document, complete_event):
+            command, sep, _ = document.text_before_cursor.lstrip().partition(' ')
+            if not sep: yield from self.command_completer.get_completions(document, complete_event); return
+            # Complete only the argument under the cursor; completions are positioned relative to its end
+            word = document.get_word_before_cursor(WORD=True)
+            word_document = Document(word, len(word))
+            command = command.lower()
+            if command == "mode": yield from self.mode_completer.get_completions(word_document, complete_event)
+            elif command in ("add_doc", "batch", "run"): yield from self.path_completer.get_completions(word_document, complete_event)
+            elif command == "set_docs":
+                # Uses whatever list_docs/set_docs last cached; never hits the network while typing
+                doc_completer = WordCompleter(sorted(APP_STATE["doc_index"] or ()), WORD=True)
+                yield from doc_completer.get_completions(word_document, complete_event)
+
+    try: _ensure_config_dir(); history = FileHistory(str(HISTORY_PATH))
+    except OSError: history = None
+    return PromptSession(completer=CommandCompleter(), history=history, complete_while_typing=False)
 
 def main():
     console.print("[bold]Welcome to the ClauseCompass Decision Engine CLI! 🧭[/bold] Type 'help' for commands.")
+    if _load_cached_token(): console.print(f"[green]Resumed session for {APP_STATE['user_email']}.[/green]")
+    prompt_session = _build_prompt_session()
     while True:
         try:
-            user_input = console.input(get_current_prompt()).strip()
+            # prompt_toolkit takes the callable and only rebuilds the prompt on redraw
+            if prompt_session: user_input = prompt_session.prompt(get_current_prompt).strip()
+            else: user_input = console.input(get_current_prompt()).strip()
             if not user_input: continue
-
-            parts = user_input.split(' ', 1)
-            command = parts[0].lower()
-            args = parts[1] if len(parts) > 1 else ""
-
-            if command in COMMANDS:
-                COMMANDS[command](args)
-            else:
-                handle_query(user_input)
+            dispatch(user_input)
         
         except (KeyboardInterrupt, EOFError, SystemExit):
             console.print("\n[bold]Exiting...[/bold]"); break